@@ -26,7 +26,8 @@ def make_filterbanks(n_fft=4096,
 
 class TorchSTFT(nn.Module):
     """Multichannel Short-Time-Fourier Forward transform
-    uses hard coded hann_window.
+    uses hard coded hann_window. Samples and channels are packed into a
+    single batched `torch.stft` call on the device of the input.
     Args:
         n_fft (int, optional): transform FFT size. Defaults to 4096.
         n_hop (int, optional): transform hop size. Defaults to 1024.
@@ -92,7 +93,8 @@ class TorchSTFT(nn.Module):
 
 class TorchISTFT(nn.Module):
     """Multichannel Inverse-Short-Time-Fourier functional
-    wrapper for torch.istft to support batches
+    wrapper for torch.istft to support batches, all leading dimensions
+    are packed into a single `torch.istft` call
     Args:
         STFT (Tensor): complex stft of
             shape (nb_samples, nb_channels, nb_bins, nb_frames, complex=2)
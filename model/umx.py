@@ -1,17 +1,36 @@
 # Based on https://github.com/sigsep/open-unmix-pytorch/blob/master/openunmix/model.py
+import hashlib
 import numpy as np
 import os
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import warnings
 from torch import Tensor
 from torch.nn import LSTM, BatchNorm1d, Linear, Parameter
-from typing import Optional, Mapping
+from typing import List, Optional, Mapping, Tuple
 
 from . import Separator
 from dsp.filtering import wiener
 from dsp.transforms import make_filterbanks, ComplexNorm
 
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+# bump whenever MultiUMX changes what is baked into scripted/exported models
+_CACHE_VERSION = 1
+
+
+@torch.jit.script
+def _apply_mask(x: Tensor,
+                mix: Tensor,
+                output_scale: Tensor,
+                output_mean: Tensor) -> Tensor:
+    """Scripted so that the elementwise chain is fused into one kernel"""
+    return torch.relu(x * output_scale + output_mean) * mix
+
 
 class OpenUnmix(nn.Module):
     """OpenUnmix Core spectrogram based separation module.
@@ -121,7 +140,7 @@ class OpenUnmix(nn.Module):
         # get current spectrogram shape
         nb_frames, nb_samples, nb_channels, nb_bins = x.data.shape
 
-        mix = x.detach().clone()
+        mix = x.detach()
 
         # crop
         x = x[..., : self.nb_bins]
@@ -157,16 +176,244 @@ class OpenUnmix(nn.Module):
         # reshape back to original dim
         x = x.reshape(nb_frames, nb_samples, nb_channels, self.nb_output_bins)
 
-        # apply output scaling
-        x *= self.output_scale
-        x += self.output_mean
-
-        # since our output is non-negative, we can apply RELU
-        x = F.relu(x) * mix
+        # apply output scaling and, since our output is non-negative, RELU
+        x = _apply_mask(x, mix, self.output_scale, self.output_mean)
         # permute back to (nb_samples, nb_channels, nb_bins, nb_frames)
         return x.permute(1, 2, 3, 0)
 
 
+class MultiUMX(nn.Module):
+    """Inference-only fusion of several OpenUnmix target models.
+    All targets receive the same mixture spectrogram, so the dense stages
+    of the target models are stacked and evaluated with one batched matmul
+    per stage. Batch norms are folded into the preceding dense layers in
+    their eval form. The recurrent stage keeps one LSTM per target since
+    their weights differ.
+    Args:
+        models (list of OpenUnmix): target models sharing `nb_bins`,
+            `nb_output_bins` and `hidden_size`
+        crop_output (bool): Only estimate the bins below `max_bin` and set
+            the ones above to zero, which shrinks fc3/bn3 accordingly.
+            Changes the output unless the upper band is discarded anyway.
+            (Default `False`)
+    """
+
+    def __init__(self, models, crop_output: bool = False):
+        super(MultiUMX, self).__init__()
+        self.nb_bins = models[0].nb_bins
+        self.nb_output_bins = models[0].nb_output_bins
+        self.hidden_size = models[0].hidden_size
+        # number of bins actually estimated by the models
+        self.nb_mask_bins = self.nb_bins if crop_output else self.nb_output_bins
+
+        self.lstms = nn.ModuleList([model.lstm for model in models])
+
+        self.register_buffer('output_scale', _stack_param(models, 'output_scale')[:, : self.nb_mask_bins])
+        self.register_buffer('output_mean', _stack_param(models, 'output_mean')[:, : self.nb_mask_bins])
+
+        # (nb_targets, num_features) eval-mode batch norms as `x * scale + shift`
+        bn_affines = {}
+        for name in ['bn1', 'bn2', 'bn3']:
+            scale, shift = zip(*[_batchnorm_affine(getattr(model, name)) for model in models])
+            bn_affines[name] = torch.stack(scale), torch.stack(shift)
+
+        # fold the input normalization `(x + input_mean) * input_scale` into
+        # fc1, which turns it into a single linear layer shared by all targets
+        input_mean = _stack_param(models, 'input_mean')
+        input_scale = _stack_param(models, 'input_scale')
+        fc1_weight = _stack_param(models, 'fc1.weight')
+        nb_targets, hidden_size, nb_features = fc1_weight.shape
+        fc1_weight = fc1_weight.reshape(nb_targets, hidden_size, -1, self.nb_bins)
+        fc1_bias = torch.einsum('thcb,tb->th', fc1_weight, input_mean * input_scale)
+        fc1_weight = (fc1_weight * input_scale[:, None, None, :]).reshape(nb_targets, hidden_size, -1)
+        fc1_weight, fc1_bias = _fold_batchnorm(fc1_weight, fc1_bias, *bn_affines['bn1'])
+        # (nb_targets * hidden_size, nb_channels * nb_bins)
+        self.register_buffer('fc1_weight', fc1_weight.reshape(-1, nb_features))
+        # (nb_targets * hidden_size,)
+        self.register_buffer('fc1_bias', fc1_bias.reshape(-1))
+
+        # (nb_targets, out_features, in_features) and (nb_targets, out_features)
+        fc2_weight, fc2_bias = _fold_batchnorm(_stack_param(models, 'fc2.weight'), None, *bn_affines['bn2'])
+        self.register_buffer('fc2_weight', fc2_weight)
+        self.register_buffer('fc2_bias', fc2_bias)
+
+        # the fc3 outputs are laid out as (nb_channels, nb_output_bins)
+        fc3_weight, fc3_bias = _fold_batchnorm(_stack_param(models, 'fc3.weight'), None, *bn_affines['bn3'])
+        self.register_buffer('fc3_weight', self._crop_output_bins(fc3_weight))
+        self.register_buffer('fc3_bias', self._crop_output_bins(fc3_bias))
+
+    def _crop_output_bins(self, x: Tensor) -> Tensor:
+        """Keep the first `nb_mask_bins` of every channel along dim 1"""
+        shape = x.shape
+        x = x.reshape(shape[0], -1, self.nb_output_bins, *shape[2:])[:, :, : self.nb_mask_bins]
+        return x.reshape(shape[0], -1, *shape[2:])
+
+    def forward(self, x: Tensor) -> Tensor:
+        """
+        Args:
+            x: input spectrogram of shape
+                `(nb_samples, nb_channels, nb_bins, nb_frames)`
+        Returns:
+            Tensor: filtered spectrograms of shape
+                `(nb_targets, nb_samples, nb_channels, nb_bins, nb_frames)`
+        """
+        nb_samples, nb_channels, nb_bins, nb_frames = x.shape
+        nb_targets = len(self.lstms)
+
+        mix = x.detach()
+
+        # crop
+        x = x[:, :, : self.nb_bins]
+
+        # normalize and encode for all targets in one matmul. With
+        # nb_bins < nb_output_bins the cropped (c, b) axes cannot be merged,
+        # so einsum still copies the cropped input once before the GEMM
+        x = torch.einsum('ncbf,hcb->fnh',
+                         x,
+                         self.fc1_weight.reshape(-1, nb_channels, self.nb_bins)) + self.fc1_bias
+        # split to (nb_targets, nb_frames*nb_samples, hidden_size)
+        x = x.reshape(-1, nb_targets, self.hidden_size).transpose(0, 1)
+        x = torch.tanh(x)
+        x = x.reshape(nb_targets, nb_frames, nb_samples, self.hidden_size)
+
+        # apply the stacked LSTM of every target with skip connection
+        lstm_out: List[Tensor] = []
+        for j, lstm in enumerate(self.lstms):
+            lstm_out.append(lstm(x[j])[0])
+        x = torch.cat([x, torch.stack(lstm_out)], -1)
+
+        x = torch.baddbmm(self.fc2_bias[:, None, :],
+                          x.reshape(nb_targets, -1, x.shape[-1]),
+                          self.fc2_weight.transpose(1, 2))
+        x = F.relu(x)
+
+        x = torch.baddbmm(self.fc3_bias[:, None, :], x, self.fc3_weight.transpose(1, 2))
+
+        # to (nb_targets, nb_samples, nb_channels, nb_bins, nb_frames)
+        x = x.reshape(nb_targets, nb_frames, nb_samples, nb_channels, self.nb_mask_bins)
+        x = x.permute(0, 2, 3, 4, 1)
+
+        # apply output scaling and, since our output is non-negative, RELU
+        x = _apply_mask(x, mix[:, :, : self.nb_mask_bins],
+                        self.output_scale[:, None, None, :, None],
+                        self.output_mean[:, None, None, :, None])
+        if self.nb_mask_bins < self.nb_output_bins:
+            x = F.pad(x, (0, 0, 0, self.nb_output_bins - self.nb_mask_bins))
+        return x
+
+
+class ONNXUnmix(nn.Module):
+    """Runs an exported MultiUMX graph with ONNX Runtime behind the
+    MultiUMX interface. TensorRT is used in FP16 mode when available.
+    Input and output are bound to torch memory on the model device, so
+    no host round trip is made. If ONNX Runtime cannot run on that device
+    (e.g. only the CPU package is installed), they go through host memory.
+    Args:
+        onnx_path (str): path of the exported model
+        nb_targets (int): number of targets stacked in the output
+        device (torch.device): device the inputs live on
+        trt_profile (dict or None): TensorRT optimization profile as
+            `{'min': shape, 'opt': shape, 'max': shape}` of the input. The
+            engine built for it is cached next to `onnx_path`
+    """
+
+    def __init__(self,
+                 onnx_path: str,
+                 nb_targets: int,
+                 device: torch.device,
+                 trt_profile: Optional[dict] = None):
+        super(ONNXUnmix, self).__init__()
+        self.nb_targets = nb_targets
+        device = torch.device(device)
+        self.device_type = device.type
+        if device.type == 'cuda':
+            self.device_id = device.index if device.index is not None else torch.cuda.current_device()
+        else:
+            self.device_id = 0
+
+        available_providers = ort.get_available_providers()
+
+        # reuse built engines across processes instead of rebuilding them
+        trt_cache_dir = os.path.splitext(onnx_path)[0] + '_trt'
+        if self.device_type == 'cuda' and 'TensorrtExecutionProvider' in available_providers:
+            os.makedirs(trt_cache_dir, exist_ok=True)
+        trt_options = {'device_id': self.device_id,
+                       'trt_fp16_enable': True,
+                       'trt_engine_cache_enable': True,
+                       'trt_engine_cache_path': trt_cache_dir}
+        if trt_profile is not None:
+            for name in ['min', 'opt', 'max']:
+                shape = 'x'.join(str(size) for size in trt_profile[name])
+                trt_options[f'trt_profile_{name}_shapes'] = f'input:{shape}'
+
+        providers = [('TensorrtExecutionProvider', trt_options),
+                     ('CUDAExecutionProvider', {'device_id': self.device_id}),
+                     'CPUExecutionProvider']
+        if self.device_type != 'cuda':
+            providers = providers[-1:]
+        self.session = ort.InferenceSession(
+            onnx_path,
+            providers=[provider for provider in providers
+                       if (provider[0] if isinstance(provider, tuple) else provider) in available_providers]
+        )
+
+        # TensorRT cannot run shapes outside of the profile its engine was built for
+        self.max_shape = None
+        if trt_profile is not None and 'TensorrtExecutionProvider' in self.session.get_providers():
+            self.max_shape = tuple(trt_profile['max'])
+
+        # device on which ONNX Runtime reads the input and writes the output
+        if self.device_type == 'cuda' and 'CUDAExecutionProvider' not in self.session.get_providers():
+            warnings.warn('onnxruntime has no CUDA support, running UMX on the CPU.')
+            self.io_device = torch.device('cpu')
+        else:
+            self.io_device = device
+
+    def forward(self, x: Tensor) -> Tensor:
+        if self.max_shape is not None and any(size > max_size for size, max_size in zip(x.shape, self.max_shape)):
+            raise ValueError(f'Input of shape {tuple(x.shape)} exceeds the TensorRT profile {self.max_shape}, '
+                             'increase onnx_max_batch or onnx_max_duration of the separator.')
+        device = x.device
+        x = x.detach().to(device=self.io_device, dtype=torch.float32).contiguous()
+        output = torch.empty((self.nb_targets,) + tuple(x.shape), dtype=torch.float32, device=x.device)
+
+        if x.is_cuda:
+            # ONNX Runtime runs on its own stream, the input has to be ready
+            torch.cuda.current_stream(x.device).synchronize()
+
+        io_device_id = self.device_id if x.is_cuda else 0
+        binding = self.session.io_binding()
+        binding.bind_input('input', x.device.type, io_device_id,
+                           np.float32, tuple(x.shape), x.data_ptr())
+        binding.bind_output('output', x.device.type, io_device_id,
+                            np.float32, tuple(output.shape), output.data_ptr())
+        self.session.run_with_iobinding(binding)
+        binding.synchronize_outputs()
+        return output.to(device)
+
+
+def _stack_param(models, name: str) -> Tensor:
+    return torch.stack([model.get_parameter(name).detach() for model in models])
+
+
+def _batchnorm_affine(bn: BatchNorm1d):
+    """Express an eval-mode batch norm as `x * scale + shift`"""
+    scale = bn.weight.detach() / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias.detach() - bn.running_mean * scale
+    return scale, shift
+
+
+def _fold_batchnorm(weight: Tensor,
+                    bias: Optional[Tensor],
+                    scale: Tensor,
+                    shift: Tensor):
+    """Fold `x * scale + shift` applied after the stacked linear layers
+    `(weight, bias)` into their weight and bias"""
+    if bias is None:
+        bias = torch.zeros_like(shift)
+    return weight * scale[..., None], bias * scale + shift
+
+
 class UMXSeparator(Separator):
     def __init__(self,
                  device,
@@ -174,7 +421,14 @@ class UMXSeparator(Separator):
                  residual=True,
                  wiener_win_len=300,
                  num_iter=0,
-                 softmask=False):
+                 softmask=False,
+                 compile_model=False,
+                 bf16=False,
+                 crop_output=False,
+                 onnx=False,
+                 onnx_max_duration=600.0,
+                 onnx_max_batch=1,
+                 cache_dir=None):
         super(UMXSeparator, self).__init__(device, model_cfg)
         self._residual = residual
         self._window_size = self._model_cfg.stft.window_size
@@ -185,6 +439,24 @@ class UMXSeparator(Separator):
         self._wiener_win_len = wiener_win_len
         self._num_iter = num_iter
         self._softmask = softmask
+        self._compile_model = compile_model
+        # opt-in bfloat16 inference, falls back to float32 on devices
+        # without bfloat16 support (e.g. pre-Ampere GPUs and CPUs)
+        self._bf16 = bf16 and torch.device(device).type == 'cuda' and torch.cuda.is_bf16_supported()
+        if bf16 and not self._bf16:
+            warnings.warn(f'bfloat16 is not supported on {device}, running UMX in float32.')
+        self._crop_output = crop_output
+        if onnx and ort is None:
+            raise ImportError('onnx=True requires onnxruntime, install onnxruntime-gpu '
+                              '(or onnxruntime for CPU only).')
+        self._onnx = onnx
+        self._onnx_max_duration = onnx_max_duration
+        self._onnx_max_batch = onnx_max_batch
+        if onnx and compile_model:
+            raise ValueError('onnx and compile_model cannot be used together.')
+        # directory of the scripted/exported models, defaults to the model_dir
+        # passed to load_model
+        self._cache_dir = cache_dir
 
         self._stft, self._istft = make_filterbanks(
             n_fft=self._window_size,
@@ -194,6 +466,11 @@ class UMXSeparator(Separator):
         )
         self._complexnorm = ComplexNorm(mono=self._model_cfg.audio.mono)
         self._target_models = dict()
+        self._model = None
+        # output buffer reused across calls with the same input shape
+        self._targets_stft_buffer = None
+        # to_dict aggregation matrices keyed by targets and aggregate_dict
+        self._aggregation_matrices = dict()
 
     def load_model(self,
                    targets=None,
@@ -216,11 +493,103 @@ class UMXSeparator(Separator):
             state_dict = torch.load(os.path.join(model_dir, f'{target}_best.pth'),
                                     map_location=self._device)
             target_unmix.load_state_dict(state_dict, strict=False)
-            target_unmix.eval()
+            target_unmix.freeze()
             target_unmix.to(self._device)
             target_models[target] = target_unmix
 
         self._target_models = target_models
+        # all targets see the same input, run them as one batched forward
+        self._model = MultiUMX(list(target_models.values()),
+                               crop_output=self._crop_output).to(self._device)
+
+        if self._onnx:
+            self._model = self._export_onnx(self._model, targets, model_dir)
+        elif self._compile_model:
+            self._model = self._compile(self._model, targets, model_dir)
+
+    def _cache_path(self,
+                    targets: List[str],
+                    model_dir: str,
+                    suffix: str) -> Tuple[str, bool]:
+        """Path of a file derived from the target checkpoints and whether
+        it exists and is newer than all of them. The file name carries a
+        hash of the other settings baked into the file"""
+        settings = (_CACHE_VERSION,
+                    self._model_cfg.train.hidden_size,
+                    self._num_channels,
+                    self._window_size,
+                    self._max_freq_bins,
+                    self._crop_output,
+                    torch.__version__)
+        digest = hashlib.sha1(repr(settings).encode()).hexdigest()[:12]
+        cache_dir = self._cache_dir if self._cache_dir is not None else model_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        path = os.path.join(cache_dir, f'{"_".join(targets)}_{digest}{suffix}')
+        checkpoint_paths = [os.path.join(model_dir, f'{target}_best.pth') for target in targets]
+        is_fresh = os.path.isfile(path) and \
+            os.path.getmtime(path) >= max(map(os.path.getmtime, checkpoint_paths))
+        return path, is_fresh
+
+    def _export_onnx(self,
+                     model: nn.Module,
+                     targets: List[str],
+                     model_dir: str) -> nn.Module:
+        """Export the batched target model to ONNX in the cache directory and run it
+        with ONNX Runtime, preferring the TensorRT and CUDA providers"""
+        onnx_path, is_fresh = self._cache_path(targets, model_dir, '.onnx')
+        if not is_fresh:
+            dummy_X = torch.rand(1, self._num_channels, self._window_size // 2 + 1, 16,
+                                 device=self._device)
+            torch.onnx.export(model, dummy_X, onnx_path,
+                              opset_version=17,
+                              input_names=['input'],
+                              output_names=['output'],
+                              dynamic_axes={'input': {0: 'batch', 3: 'frames'},
+                                            'output': {1: 'batch', 4: 'frames'}})
+
+        # a single engine covers up to `onnx_max_batch` mixtures of up to
+        # `onnx_max_duration` seconds, tuned for one training excerpt
+        nb_bins = self._window_size // 2 + 1
+        trt_profile = {
+            'min': (1, self._num_channels, nb_bins, 1),
+            'opt': (1, self._num_channels, nb_bins, self._nb_frames(self._model_cfg.audio.chunk_dur)),
+            'max': (self._onnx_max_batch, self._num_channels, nb_bins,
+                    self._nb_frames(self._onnx_max_duration)),
+        }
+        return ONNXUnmix(onnx_path, len(targets), self._device, trt_profile=trt_profile)
+
+    def _nb_frames(self, duration: float) -> int:
+        """Number of STFT frames of a centered STFT of `duration` seconds"""
+        return int(duration * self._sample_rate) // self._hop_size + 1
+
+    def _compile(self,
+                 model: nn.Module,
+                 targets: List[str],
+                 model_dir: str) -> nn.Module:
+        """Compile the batched target model so that later processes skip
+        most of the warm-up. torch.compile keeps its kernels in the Inductor
+        cache (see TORCHINDUCTOR_CACHE_DIR), the TorchScript fallback is saved
+        in the cache directory"""
+        # torch.compile is only available from torch 2.0 on
+        if hasattr(torch, 'compile'):
+            import torch._inductor.config as inductor_config
+            # the options of mode='reduce-overhead' plus the persistent FX graph cache
+            options = {'triton.cudagraphs': True}
+            if hasattr(inductor_config, 'fx_graph_cache'):
+                options['fx_graph_cache'] = True
+            return torch.compile(model, options=options)
+
+        # otherwise fall back to TorchScript
+        device_type = torch.device(self._device).type
+        scripted_path, is_fresh = self._cache_path(targets, model_dir, f'_scripted_{device_type}.pt')
+
+        # only reuse the scripted model if it is newer than all checkpoints
+        if is_fresh:
+            return torch.jit.load(scripted_path, map_location=self._device)
+
+        scripted_model = torch.jit.script(model)
+        torch.jit.save(scripted_model, scripted_path)
+        return scripted_model
 
     def forward(self,
                 mix: Tensor = None) -> Tensor:
@@ -241,20 +610,16 @@ class UMXSeparator(Separator):
         mix_stft = self._stft(mix)
         X = self._complexnorm(mix_stft)
 
-        # initializing spectrograms variable
-        spectrograms = torch.zeros(X.shape + (nb_sources,),
-                                   dtype=mix.dtype,
-                                   device=self._device)
-
-        for j, target_name in enumerate(self._target_models):
-            target_module = self._target_models[target_name]
-            # apply current model to get the source spectrogram
-            target_spectrogram = target_module(X.detach().clone())
-            spectrograms[..., j] = target_spectrogram
+        # apply all target models at once to get the source spectrograms
+        # (nb_targets, nb_samples, nb_channels, nb_bins, nb_frames)
+        with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=self._bf16):
+            target_spectrograms = self._model(X)
+        # keep the filtering below in the precision of the mixture
+        target_spectrograms = target_spectrograms.to(mix.dtype)
 
         # transposing it as
         # (nb_samples, nb_frames, nb_bins,{1,nb_channels}, nb_sources)
-        spectrograms = spectrograms.permute(0, 3, 2, 1, 4)
+        spectrograms = target_spectrograms.permute(1, 4, 3, 2, 0)
 
         # rearranging it into:
         # (nb_samples, nb_frames, nb_bins, nb_channels, 2) to feed
@@ -273,30 +638,40 @@ class UMXSeparator(Separator):
                 "one with `--residual`"
             )
 
-        nb_frames = spectrograms.shape[1]
-        targets_stft = torch.zeros(
-            mix_stft.shape + (nb_sources,),
-            dtype=mix.dtype,
-            device=mix_stft.device
-        )
+        if self._num_iter == 0:
+            # without EM the filtering is framewise, so there is no need
+            # to process the frames in windows
+            targets_stft = wiener(
+                spectrograms,
+                mix_stft,
+                self._num_iter,
+                softmask=self._softmask,
+                residual=self._residual,
+            )
+        else:
+            nb_frames = spectrograms.shape[1]
+            # every frame is written by exactly one window below
+            targets_stft = self._get_buffer('_targets_stft_buffer',
+                                            mix_stft.shape + (nb_sources,),
+                                            dtype=mix.dtype)
 
-        for sample in range(nb_samples):
-            pos = 0
             if self._wiener_win_len is not None:
                 wiener_win_len = self._wiener_win_len
             else:
                 wiener_win_len = nb_frames
-            while pos < nb_frames:
-                cur_frame = torch.arange(pos, min(nb_frames, pos + wiener_win_len))
-                pos = int(cur_frame[-1]) + 1
-
-                targets_stft[sample, cur_frame] = wiener(
-                    spectrograms[sample, cur_frame],
-                    mix_stft[sample, cur_frame],
-                    self._num_iter,
-                    softmask=self._softmask,
-                    residual=self._residual,
-                )
+
+            for sample in range(nb_samples):
+                pos = 0
+                while pos < nb_frames:
+                    end = min(nb_frames, pos + wiener_win_len)
+                    targets_stft[sample, pos:end] = wiener(
+                        spectrograms[sample, pos:end],
+                        mix_stft[sample, pos:end],
+                        self._num_iter,
+                        softmask=self._softmask,
+                        residual=self._residual,
+                    )
+                    pos = end
 
         # getting to (nb_samples, nb_targets, channel, fft_size, n_frames, 2)
         targets_stft = targets_stft.permute(0, 5, 3, 2, 1, 4).contiguous()
@@ -306,6 +681,18 @@ class UMXSeparator(Separator):
 
         return estimates, targets_stft
 
+    def _get_buffer(self,
+                    name: str,
+                    shape: torch.Size,
+                    dtype: torch.dtype) -> Tensor:
+        """Return the cached uninitialized buffer `name`, reallocating it
+        only if shape or dtype changed since the previous call"""
+        buffer = getattr(self, name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = torch.empty(shape, dtype=dtype, device=self._device)
+            setattr(self, name, buffer)
+        return buffer
+
     def to_dict(self,
                 estimates: Tensor,
                 aggregate_dict: Optional[dict] = None) -> dict:
@@ -317,22 +704,40 @@ class UMXSeparator(Separator):
         Returns:
             (dict of str: Tensor):
         """
-        estimates_dict = {}
-        for k, target in enumerate(self._target_models):
-            estimates_dict[target] = estimates[k, :, ...]
-
+        target_names = list(self._target_models)
         # in the case of residual, we added another source
         if self._residual:
-            estimates_dict["residual"] = estimates[-1, :, ...]
-
-        if aggregate_dict is not None:
-            new_estimates = {}
-            for key in aggregate_dict:
-                new_estimates[key] = torch.tensor(0.0)
+            target_names.append('residual')
+
+        if aggregate_dict is None:
+            return dict(zip(target_names, estimates.unbind(0)))
+
+        # sum up the targets of every key with a single matmul
+        aggregation_matrix = self._get_aggregation_matrix(target_names, aggregate_dict,
+                                                          dtype=estimates.dtype,
+                                                          device=estimates.device)
+        aggregated = aggregation_matrix @ estimates.reshape(len(target_names), -1)
+        aggregated = aggregated.reshape((len(aggregate_dict),) + estimates.shape[1:])
+        return dict(zip(aggregate_dict, aggregated.unbind(0)))
+
+    def _get_aggregation_matrix(self,
+                                target_names: List[str],
+                                aggregate_dict: dict,
+                                dtype: torch.dtype,
+                                device: torch.device) -> Tensor:
+        """0/1 matrix of shape (nb_keys, nb_targets) selecting the targets
+        summed up for every key of `aggregate_dict`, cached per call pattern"""
+        cache_key = (tuple(target_names),
+                     tuple((key, tuple(targets)) for key, targets in aggregate_dict.items()),
+                     dtype,
+                     device)
+        if cache_key not in self._aggregation_matrices:
+            aggregation_matrix = torch.zeros(len(aggregate_dict), len(target_names))
+            for k, key in enumerate(aggregate_dict):
                 for target in aggregate_dict[key]:
-                    new_estimates[key] = new_estimates[key] + estimates_dict[target]
-            estimates_dict = new_estimates
-        return estimates_dict
+                    aggregation_matrix[k, target_names.index(target)] += 1
+            self._aggregation_matrices[cache_key] = aggregation_matrix.to(dtype=dtype, device=device)
+        return self._aggregation_matrices[cache_key]
 
     def separate(self,
                  mix: Tensor):
@@ -341,7 +746,7 @@ class UMXSeparator(Separator):
         return estimates_dict
 def bandwidth_to_max_bin(rate: float,
                          n_fft: int,
-                         bandwidth: float) -> np.ndarray:
+                         bandwidth: float) -> int:
     """Convert bandwidth to maximum bin count
     Assuming lapped transforms such as STFT
     Parameters
@@ -352,8 +757,18 @@ def bandwidth_to_max_bin(rate: float,
 
     Returns
     -------
-        np.ndarray: maximum frequency bin
+        int: maximum frequency bin
     """
-    freqs = np.linspace(0, rate / 2, n_fft // 2 + 1, endpoint=True)
-
-    return np.max(np.where(freqs <= bandwidth)[0]) + 1
\ No newline at end of file
+    # the n_fft // 2 + 1 bin frequencies are k * step, with the last one
+    # exactly rate / 2, matching np.linspace(0, rate / 2, n_fft // 2 + 1)
+    nb_bins = n_fft // 2
+    if bandwidth >= rate / 2:
+        return nb_bins + 1
+    step = (rate / 2) / nb_bins
+    max_bin = int(np.floor(bandwidth / step))
+    # correct for the floating point rounding of k * step
+    while max_bin * step > bandwidth:
+        max_bin -= 1
+    while max_bin + 1 < nb_bins and (max_bin + 1) * step <= bandwidth:
+        max_bin += 1
+    return max_bin + 1
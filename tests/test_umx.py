@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+
+from model.umx import bandwidth_to_max_bin
+
+
+def _bandwidth_to_max_bin_linspace(rate, n_fft, bandwidth):
+    # reference implementation scanning all bin frequencies
+    freqs = np.linspace(0, rate / 2, n_fft // 2 + 1, endpoint=True)
+    return np.max(np.where(freqs <= bandwidth)[0]) + 1
+
+
+@pytest.mark.parametrize('rate', [8000, 16000, 22050, 44100, 48000])
+@pytest.mark.parametrize('n_fft', [511, 512, 1023, 1024, 2048, 4095, 4096])
+def test_bandwidth_to_max_bin(rate, n_fft):
+    # the bin frequencies themselves are the edge cases
+    bandwidths = np.concatenate([np.linspace(0, rate / 2, n_fft // 2 + 1),
+                                 np.linspace(0, rate, 1001),
+                                 [16000.0]])
+    for bandwidth in bandwidths:
+        assert bandwidth_to_max_bin(rate, n_fft, bandwidth) == \
+            _bandwidth_to_max_bin_linspace(rate, n_fft, bandwidth)